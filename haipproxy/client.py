@@ -1,142 +1,200 @@
 import asyncio
+import json
 import logging
-import math
+import os
+import shutil
 import subprocess
 import threading
 import time
+import uuid
+from collections import Counter
 
 from scrapy.utils.misc import load_object
 from scrapy.utils.url import add_http_if_no_scheme
 from proxybroker import Broker
 
-from haipproxy.utils import get_redis_conn, RedisOps
+from haipproxy.utils import get_redis_conn, acquire_lock, release_lock, RedisOps
 from haipproxy.settings import (
     SQUID_BIN_PATH,
     SQUID_CONF_PATH,
     SQUID_TEMPLATE_PATH,
     LOWEST_SCORE,
     MIN_PROXY_LEN,
+    PROXY_WRITE_BATCH_SIZE,
+    SCORE_ZSET,
+    POOL_SNAPSHOT,
+    POOL_SNAPSHOT_ID,
+    POOL_SNAPSHOT_TTL,
+    POOL_CHECK_INTERVAL,
+    POOL_SIZE,
 )
 
 logger = logging.getLogger(__name__)
 
+SQUID_PATH = shutil.which("squid") or SQUID_BIN_PATH
+
+STATE_GOOD = 1
+STATE_DEAD = 2
+
 
 class ProxyClient(object):
     def __init__(self):
         self.redis_conn = get_redis_conn()
-        self.ppool = []
-        self.good = set()
-        self.dead = set()
-        self.idx = -1
+        # proxies sorted by score, keyed by protocol. "" holds all of them
+        self.buckets = {}
+        # proxy -> STATE_GOOD or STATE_DEAD, guarded by state_lock
+        self.state = {}
+        self.state_count = Counter()
+        self.state_lock = threading.Lock()
+        # id of the shared snapshot the buckets were loaded from
+        self.snapshot_id = None
+        self.pool_checked = 0
         self.ro = RedisOps()
         # t = threading.Thread(target=self._refresh_periodically)
         # t.setDaemon(True)
 
+    def _set_state(self, proxy, state):
+        """Set the state of a proxy and return its previous one"""
+        with self.state_lock:
+            prev = self.state.get(proxy)
+            if prev != state:
+                self.state[proxy] = state
+                self.state_count[state] += 1
+                if prev is not None:
+                    self.state_count[prev] -= 1
+        return prev
+
     def mark_dead(self, proxy):
         """ Mark a proxy as dead """
-        if proxy in self.good:
-            self.good.discard(proxy)
+        if self._set_state(proxy, STATE_DEAD) == STATE_GOOD:
             logger.debug("GOOD proxy became DEAD: <%s>" % proxy)
-        self.dead.add(proxy)
         # ProxyStatInc
 
     def mark_good(self, proxy):
         """ Mark a proxy as good """
-        self.good.add(proxy)
+        self._set_state(proxy, STATE_GOOD)
         # ProxyStatInc
 
     def set_stats(self, stats):
-        stats.set_value("proxies/unused", len(self.ppool) - self.idx)
-        stats.set_value("proxies/dead", len(self.dead))
-        stats.set_value("proxies/good", len(self.good))
+        stats.set_value("proxies/dead", self.state_count[STATE_DEAD])
+        stats.set_value("proxies/good", self.state_count[STATE_GOOD])
 
     def del_all_fails(self):
-        def need_op(row):
-            return float(row[b"score"]) <= LOWEST_SCORE - 2
-
-        self.ro.map_all("delete", need_op, match="http*://*")
+        fails = self.redis_conn.zrangebyscore(SCORE_ZSET, "-inf", LOWEST_SCORE - 2)
+        if fails:
+            pipe = self.redis_conn.pipeline(transaction=False)
+            pipe.delete(*fails)
+            pipe.zrem(SCORE_ZSET, *fails)
+            # clients reload once the snapshot is gone
+            pipe.delete(POOL_SNAPSHOT, POOL_SNAPSHOT_ID)
+            pipe.execute()
+        logger.info(f"{len(fails)} failed proxies deleted")
 
     def proxy_gen(self, protocol=""):
         # todo: infinite. switch to good set
-        if not self.ppool:
-            self._fill_pool()
-        self.protocol = protocol.lower()
-        if self.protocol != "":
-            self.protocol += ":"
-        while 1:
-            self.idx = self.idx + 1
-            if self.idx >= len(self.ppool):
-                self.idx = -1
-                raise StopIteration
-            if self.ppool[self.idx][1].startswith(self.protocol):
-                yield self.ppool[self.idx][1]
+        self.refresh_pool()
+        return iter(self.buckets.get(protocol.lower(), ()))
 
     def _refresh_periodically(self):
         while True:
             # lock
-            self.ppool.clear()
+            self.buckets.clear()
             self._fill_pool()
             time.sleep(3600)
 
+    def refresh_pool(self):
+        """Reload the pool once the shared snapshot was rebuilt, expired or dropped"""
+        now = time.monotonic()
+        if self.buckets.get("") and now - self.pool_checked < POOL_CHECK_INTERVAL:
+            return
+        self.pool_checked = now
+        snapshot_id = self.redis_conn.get(POOL_SNAPSHOT_ID)
+        if snapshot_id is None or snapshot_id != self.snapshot_id:
+            self._fill_pool()
+
     def _fill_pool(self):
-        total = 0
-        for pkey in self.redis_conn.scan_iter(match="http*://*"):
-            total += 1
-            stat = self.redis_conn.hgetall(pkey)
-            score = self.cal_score(stat)
-            self.redis_conn.hset(pkey, "score", score)
-            if score > LOWEST_SCORE:
-                self.ppool.append((score, pkey.decode()))
-        self.ppool.sort(reverse=True)
-        logger.info(f"{len(self.ppool)} proxies loaded. {total} scanned totally")
-
-    def cal_score(self, stat):
-        used_count = int(stat[b"used_count"])
-        success_count = int(stat[b"success_count"])
-        total_seconds = int(stat[b"total_seconds"])
-        last_fail = stat[b"last_fail"]
-        timestamp = int(stat[b"timestamp"])
-        score = float(stat[b"score"])
-        if success_count == 0:
-            return -used_count
-        # features:
-        # 1. success rate
-        # 2. success count
-        # 3. freshness
-        # 4. last success
-        # 5. speed
-        # math.log(3600 * 24 * 180) = 16.56
-        # math.log(3600 * 24 * 30) = 14.78
-        # math.log(3600 * 24) = 11.37
-        # math.log(3600) = 8.19
-        return round(
-            2 * float(success_count) / used_count
-            + 0.5 * success_count
-            + 0.25 * (16.56 - math.log(time.time() - timestamp))
-            + 1 * (2 if last_fail == b"" else -1)
-            + 0.20 * max(0, (15 - float(total_seconds) / success_count)),
-            2,
-        )
+        pipe = self.redis_conn.pipeline()
+        pipe.get(POOL_SNAPSHOT_ID)
+        pipe.get(POOL_SNAPSHOT)
+        snapshot_id, snapshot = pipe.execute()
+        if snapshot_id is None or snapshot is None:
+            snapshot_id, snapshot = self._build_snapshot()
+        buckets = {"": []}
+        for _, proxy in json.loads(snapshot):
+            buckets[""].append(proxy)
+            buckets.setdefault(proxy.split(":", 1)[0], []).append(proxy)
+        self.snapshot_id = snapshot_id
+        self.buckets = buckets
+        logger.info(f"{len(buckets[''])} proxies loaded")
+
+    def _build_snapshot(self):
+        """Only one client queries the score zset, the others reuse its snapshot"""
+        identifier = acquire_lock(self.redis_conn, "snapshot")
+        try:
+            pipe = self.redis_conn.pipeline()
+            pipe.get(POOL_SNAPSHOT_ID)
+            pipe.get(POOL_SNAPSHOT)
+            snapshot_id, snapshot = pipe.execute()
+            if snapshot_id is None or snapshot is None:
+                # redis only walks the top of the zset when the pool is capped
+                limit = {"start": 0, "num": POOL_SIZE} if POOL_SIZE else {}
+                ppool = [
+                    (score, pkey.decode())
+                    for pkey, score in self.redis_conn.zrevrangebyscore(
+                        SCORE_ZSET,
+                        "+inf",
+                        f"({LOWEST_SCORE}",
+                        withscores=True,
+                        **limit,
+                    )
+                ]
+                snapshot = json.dumps(ppool)
+                snapshot_id = None
+                # an empty pool isn't shared so clients keep retrying the zset
+                if ppool:
+                    snapshot_id = str(uuid.uuid4()).encode()
+                    pipe = self.redis_conn.pipeline()
+                    pipe.set(POOL_SNAPSHOT_ID, snapshot_id, ex=POOL_SNAPSHOT_TTL)
+                    pipe.set(POOL_SNAPSHOT, snapshot, ex=POOL_SNAPSHOT_TTL)
+                    pipe.execute()
+            return snapshot_id, snapshot
+        finally:
+            if identifier:
+                release_lock(self.redis_conn, "snapshot", identifier)
 
     def load_file(self, fname):
         with open(fname, "r") as f:
             total = 0
-            for line in f.readlines():
+            pending = []
+            for line in f:
                 total += 1
                 proxy = line.strip()
                 if len(proxy) < MIN_PROXY_LEN or proxy.startswith("#"):
                     continue
-                proxy = add_http_if_no_scheme(proxy)
-                self.ro.set_proxy(proxy)
+                pending.append(add_http_if_no_scheme(proxy))
+                if len(pending) >= PROXY_WRITE_BATCH_SIZE:
+                    self.ro.set_proxies_pipeline(pending)
+                    pending = []
+            self.ro.set_proxies_pipeline(pending)
             logger.info(f"{total} lines")
 
     def dump_proxies(self, fname):
         with open(fname, "w") as f:
-            for p in self.proxy_gen():
+            for p in self.all_proxies():
                 f.write(p + "\n")
 
+    def all_proxies(self):
+        """Every usable proxy by descending score, not capped by POOL_SIZE"""
+        for pkey in self.redis_conn.zrevrangebyscore(
+            SCORE_ZSET, "+inf", f"({LOWEST_SCORE}"
+        ):
+            yield pkey.decode()
+
     async def _consume(self, aqu):
         """Save proxies to redis"""
+        loop = asyncio.get_event_loop()
+        writing = None
+        pending = []
         while True:
             proxy = await aqu.get()
             if proxy is None:
@@ -144,8 +202,19 @@ class ProxyClient(object):
                 break
             for protocol in proxy.types or ["http", "https"]:
                 row = "%s://%s:%d" % (protocol, proxy.host, proxy.port)
-                self.ro.set_proxy(row)
-        self.ro.flush()
+                pending.append(row)
+            if len(pending) >= PROXY_WRITE_BATCH_SIZE:
+                # write in a thread so the broker keeps grabbing meanwhile,
+                # with at most one batch in flight
+                if writing:
+                    await writing
+                writing = loop.run_in_executor(
+                    None, self.ro.set_proxies_pipeline, pending
+                )
+                pending = []
+        if writing:
+            await writing
+        self.ro.set_proxies_pipeline(pending)
 
     def grab_proxybroker(self):
         aqu = asyncio.Queue()
@@ -170,21 +239,23 @@ class SquidClient(object):
     def __init__(self):
         self.tmp_path = SQUID_TEMPLATE_PATH
         self.conf_path = SQUID_CONF_PATH
-        r = subprocess.check_output("which squid", shell=True)
-        self.squid_path = r.decode().strip()
+        self.squid_path = SQUID_PATH
+        with open(self.tmp_path, "r") as f:
+            self.template = f.read()
 
     def update_conf(self):
-        with open(self.tmp_path, "r") as fr, open(self.conf_path, "w") as fw:
-            fw.write(fr.read())
-            pc = ProxyClient()
-            idx = 0
-            for proxy in pc.proxy_gen():
-                _, ip_port = proxy.split("://")
-                ip, port = ip_port.split(":")
-                fw.write("\n")
-                fw.write(self.default_conf_detail.format(ip, port, idx))
-            fw.write("\n")
-            fw.write("\n".join(self.other_confs))
+        lines = [self.template]
+        pc = ProxyClient()
+        for idx, proxy in enumerate(pc.all_proxies()):
+            _, ip_port = proxy.split("://")
+            ip, port = ip_port.split(":")
+            lines.append(self.default_conf_detail.format(ip, port, idx))
+        lines.extend(self.other_confs)
+        # squid must never read a half written conf
+        tmp_conf_path = self.conf_path + ".tmp"
+        with open(tmp_conf_path, "w") as fw:
+            fw.write("\n".join(lines))
+        os.replace(tmp_conf_path, self.conf_path)
         # in docker, execute with shell will fail
         subprocess.call([self.squid_path, "-k", "reconfigure"], shell=False)
         logger.info("Squid conf is successfully updated")
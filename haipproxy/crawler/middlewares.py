@@ -80,6 +80,8 @@ class RotatingProxyMiddleware(object):
 
     def __init__(self, max_proxies_to_try, crawler):
         self.pc = ProxyClient()
+        # one running proxy iterator per protocol, restarted once exhausted
+        self.proxy_gens = {}
         self.max_proxies_to_try = max_proxies_to_try
         self.stats = crawler.stats
 
@@ -96,13 +98,20 @@ class RotatingProxyMiddleware(object):
         if "proxy" in request.meta and not request.meta.get("_rotating_proxy"):
             return
         protocol = "https" if request.url.startswith("https") else "http"
-        proxy = next(self.pc.proxy_gen(protocol))
+        proxy = self._next_proxy(protocol)
         if not proxy:
             raise CloseSpider("no_proxies")
         request.meta["proxy"] = proxy
         request.meta["download_slot"] = proxy
         request.meta["_rotating_proxy"] = True
 
+    def _next_proxy(self, protocol):
+        proxy = next(self.proxy_gens.get(protocol, iter(())), None)
+        if proxy is None:
+            self.proxy_gens[protocol] = self.pc.proxy_gen(protocol)
+            proxy = next(self.proxy_gens[protocol], None)
+        return proxy
+
     def process_exception(self, request, exception, spider):
         return self._handle_result(request, spider)
 
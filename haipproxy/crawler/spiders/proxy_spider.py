@@ -2,13 +2,13 @@
 Basic proxy ip crawler.
 """
 import logging
+import re
 from urllib.parse import urlparse
 
 import scrapy
-from scrapy.utils.url import add_http_if_no_scheme
+from lxml import etree
 from scrapy_splash.request import SplashRequest
 
-from haipproxy.settings import MIN_PROXY_LEN
 from haipproxy.crawler.items import ProxyUrlItem
 from haipproxy.utils import is_valid_proxy
 from .redis_spiders import RedisSpider
@@ -74,6 +74,33 @@ PROXY_SITES = {
 }
 # 'http://tools.rosinstrument.com/raw_free_db.htm?0&t=1'
 
+# xpath expressions are compiled once instead of on every response
+SITE_XPATHS = {
+    site: {
+        "row": etree.XPath(conf.get("row_xpath", "//table/tbody/tr")),
+        "col": etree.XPath(conf.get("col_xpath", "td")),
+    }
+    for site, conf in PROXY_SITES.items()
+}
+TEXT_XPATH = etree.XPath("text()")
+# one proxy per line in plain text lists, the scheme defaults to http
+PROXY_LINE_RE = re.compile(
+    r"^[ \t]*(?:(https?|sock[45])://)?(\d{1,3}(?:\.\d{1,3}){3}):(\d{1,5})[ \t\r]*$",
+    re.M,
+)
+# protocol column texts seen on the proxy sites -> protocols
+PROTOCOL_MAP = {
+    "http": ("http",),
+    "https": ("https",),
+    "http,https": ("http", "https"),
+    "socks4/5": ("sock4", "sock5"),
+}
+
+
+def first_text(node):
+    texts = TEXT_XPATH(node)
+    return texts[0] if texts else None
+
 
 class ProxySpider(scrapy.Spider):
     name = "proxy"
@@ -81,7 +108,7 @@ class ProxySpider(scrapy.Spider):
         "ITEM_PIPELINES": {"haipproxy.crawler.pipelines.ProxyIPPipeline": 200},
         "AJAXCRAWL_ENABLED": True,
     }
-    default_protocols = ["http", "https"]
+    default_protocols = ("http", "https")
 
     def start_requests(self):
         ajax_urls = []
@@ -116,47 +143,47 @@ class ProxySpider(scrapy.Spider):
             from scrapy.shell import inspect_response
 
             inspect_response(response, self)
-        row_xpath = PROXY_SITES[site].get("row_xpath", "//table/tbody/tr")
-        col_xpath = PROXY_SITES[site].get("col_xpath", "td")
-        ip_pos = PROXY_SITES[site].get("ip_pos", 0)
-        port_pos = PROXY_SITES[site].get("port_pos", 1)
-        protocal_pos = PROXY_SITES[site].get("protocal_pos", 2)
-        for row in response.xpath(row_xpath):
-            if "ransparent" in row.get() or "透明" in row.get():
-                logger.debug(f"Transparent proxy here: {row.get()}")
+        # bind everything the row loop needs to locals once per response
+        cfg = PROXY_SITES[site]
+        row_xpath = SITE_XPATHS[site]["row"]
+        col_xpath = SITE_XPATHS[site]["col"]
+        ip_pos = cfg.get("ip_pos", 0)
+        port_pos = cfg.get("port_pos", 1)
+        protocal_pos = cfg.get("protocal_pos", 2)
+        get_protocols = self.get_protocols
+        for row in row_xpath(response.selector.root):
+            row_str = etree.tostring(row, encoding="unicode", with_tail=False)
+            if "ransparent" in row_str or "透明" in row_str:
+                logger.debug(f"Transparent proxy here: {row_str}")
                 continue
-            cols = row.xpath(col_xpath)
+            cols = col_xpath(row)
             if len(cols) < 3:
                 logger.warning(f"Invalid cols: {cols}")
                 continue
-            ip = cols[ip_pos].xpath("text()").get()
-            port = cols[port_pos].xpath("text()").get()
+            ip = first_text(cols[ip_pos])
+            port = first_text(cols[port_pos])
             pro_str = (
-                ""
-                if protocal_pos == -1
-                else cols[protocal_pos].xpath("text()").get().lower()
+                "" if protocal_pos == -1 else first_text(cols[protocal_pos]).lower()
             )
-            for protocol in self.get_protocols(pro_str):
+            for protocol in get_protocols(pro_str):
                 if is_valid_proxy(ip, port, protocol):
                     yield ProxyUrlItem(url=f"{protocol}://{ip}:{port}")
                 else:
                     self.logger.error(f"invalid proxy: {protocol}://{ip}:{port}")
 
     def parse_text(self, response):
-        for line in response.text.split("\n"):
-            line = line.strip()
-            if len(line) < MIN_PROXY_LEN or line.startswith("#"):
-                continue
-            p = add_http_if_no_scheme(line)
-            if is_valid_proxy(proxy=p):
-                yield ProxyUrlItem(url=p)
+        for m in PROXY_LINE_RE.finditer(response.text):
+            protocol, ip, port = m.groups()
+            yield ProxyUrlItem(url=f"{protocol or 'http'}://{ip}:{port}")
 
     def get_protocols(self, protocol):
         if not protocol:
             return self.default_protocols
-        elif "," in protocol:
-            return protocol.split(",")
-        elif "4/5" in protocol:
-            return ["sock4", "sock5"]
-        else:
-            return [protocol]
+        protocols = PROTOCOL_MAP.get(protocol)
+        if protocols is not None:
+            return protocols
+        if "," in protocol:
+            return tuple(protocol.split(","))
+        if "4/5" in protocol:
+            return PROTOCOL_MAP["socks4/5"]
+        return (protocol,)
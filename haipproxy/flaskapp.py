@@ -2,33 +2,58 @@
 web api for haipproxy
 """
 import os
+import threading
 
-from flask import Flask, jsonify
+import orjson
+from flask import Flask, Response
 
 from haipproxy.client import ProxyClient
 
 PC = None
+PC_LOCK = threading.Lock()
+# protocol -> (snapshot id of the pool, json body)
+JSON_CACHE = {}
+JSON_CACHE_LOCK = threading.Lock()
 app = Flask(__name__)
 app.debug = bool(os.environ.get("DEBUG"))
-app.config["JSONIFY_PRETTYPRINT_REGULAR"] = True
+
+
+def fast_json(obj):
+    option = orjson.OPT_INDENT_2 if app.debug else 0
+    return Response(orjson.dumps(obj, option=option), mimetype="application/json")
 
 
 @app.errorhandler(404)
 def not_found(e):
-    return jsonify({"reason": "resource not found", "status_code": 404})
+    return fast_json({"reason": "resource not found", "status_code": 404})
 
 
 @app.errorhandler(500)
 def not_found(e):
-    return jsonify({"reason": "internal server error", "status_code": 500})
+    return fast_json({"reason": "internal server error", "status_code": 500})
 
 
 @app.route("/<protocol>")
 def get_proxies(protocol):
     global PC
-    if PC == None:
-        PC = ProxyClient()
-    return jsonify({protocol: [p for p in PC.proxy_gen(protocol)]})
+    if PC is None:
+        # first requests may race, only one of them builds the client
+        with PC_LOCK:
+            if PC is None:
+                PC = ProxyClient()
+    PC.refresh_pool()
+    snapshot_id = PC.snapshot_id
+    with JSON_CACHE_LOCK:
+        cached = JSON_CACHE.get(protocol)
+    # an entry is served until the client reloads its pool
+    if cached and snapshot_id is not None and cached[0] == snapshot_id:
+        return Response(cached[1], mimetype="application/json")
+    resp = fast_json({protocol: [p for p in PC.proxy_gen(protocol)]})
+    # only known protocols are cached so the cache stays bounded
+    if snapshot_id is not None and protocol.lower() in PC.buckets:
+        with JSON_CACHE_LOCK:
+            JSON_CACHE[protocol] = (snapshot_id, resp.get_data())
+    return resp
 
 
 @app.route("/")
@@ -116,6 +116,22 @@ REDIS_HOST = "127.0.0.1"
 REDIS_PORT = 6379
 REDIS_DB = 0
 REDIS_PIPE_BATCH_SIZE = 200
+# keys fetched per SCAN call when loading proxies
+REDIS_SCAN_COUNT = 1000
+# proxies saved per pipeline when importing them in bulk
+PROXY_WRITE_BATCH_SIZE = 500
+# sorted set indexing every proxy by its score
+SCORE_ZSET = "haipproxy:proxies:by_score"
+# sorted proxy pool shared by all clients, expired after POOL_SNAPSHOT_TTL seconds.
+# POOL_SNAPSHOT_ID changes with every rebuild so clients know when to reload
+POOL_SNAPSHOT = "haipproxy:proxies:snapshot"
+POOL_SNAPSHOT_ID = "haipproxy:proxies:snapshot:id"
+POOL_SNAPSHOT_TTL = 300
+# seconds between two checks of the snapshot id by a client
+POOL_CHECK_INTERVAL = 10
+# clients load only the POOL_SIZE best proxies, None loads all of them.
+# squid conf and file dumps always get every usable proxy
+POOL_SIZE = 1000
 
 # scheduler settings
 # 定时任务调度器设置，表示其在Redis中的Key
@@ -10,11 +10,61 @@ from haipproxy.settings import (
     REDIS_PORT,
     REDIS_DB,
     REDIS_PIPE_BATCH_SIZE,
+    REDIS_SCAN_COUNT,
     LOCKER_PREFIX,
+    SCORE_ZSET,
+    POOL_SNAPSHOT,
+    POOL_SNAPSHOT_ID,
 )
 
 logger = logging.getLogger(__name__)
 
+# Score a proxy hash in place and index it in the score zset. KEYS[1] is
+# the proxy, KEYS[2] the zset and ARGV[1] the current unix time. The score
+# is stored and returned as a string since redis truncates lua numbers to
+# integers in replies. The age of the last success is clamped to 1 second
+# so a fresh success, or a checker clock running ahead, can't yield inf/nan.
+# features:
+# 1. success rate
+# 2. success count
+# 3. freshness
+# 4. last success
+# 5. speed
+# math.log(3600 * 24 * 180) = 16.56
+# math.log(3600 * 24 * 30) = 14.78
+# math.log(3600 * 24) = 11.37
+# math.log(3600) = 8.19
+SCORE_SCRIPT = """
+local h = redis.call('HGETALL', KEYS[1])
+local stat = {}
+for i = 1, #h, 2 do
+    stat[h[i]] = h[i + 1]
+end
+local used_count = tonumber(stat['used_count']) or 0
+local success_count = tonumber(stat['success_count']) or 0
+local score
+if success_count == 0 then
+    score = 0 - used_count
+else
+    local total_seconds = tonumber(stat['total_seconds']) or 0
+    local timestamp = tonumber(stat['timestamp']) or 0
+    local last_fail = 2
+    if stat['last_fail'] ~= '' then
+        last_fail = -1
+    end
+    score = 2 * success_count / used_count
+        + 0.5 * success_count
+        + 0.25 * (16.56 - math.log(math.max(1, tonumber(ARGV[1]) - timestamp)))
+        + 1 * last_fail
+        + 0.20 * math.max(0, 15 - total_seconds / success_count)
+    score = math.floor(score * 100 + 0.5) / 100
+end
+score = tostring(score)
+redis.call('HSET', KEYS[1], 'score', score)
+redis.call('ZADD', KEYS[2], score, KEYS[1])
+return score
+"""
+
 REDIS_POOL = None
 
 
@@ -22,6 +72,8 @@ REDIS_POOL = None
 def get_redis_conn():
     global REDIS_POOL
     if REDIS_POOL == None:
+        # replies are kept as bytes and parsed by hiredis, which redis-py
+        # picks as its default parser whenever it is installed
         REDIS_POOL = redis.ConnectionPool(host=REDIS_HOST, port=REDIS_PORT, db=REDIS_DB)
     return redis.StrictRedis(connection_pool=REDIS_POOL)
 
@@ -68,6 +120,7 @@ class RedisOps(object):
         self.redis_conn = get_redis_conn()
         self.rpipe = self.redis_conn.pipeline()
         self.rpipe_size = 0
+        self.score_script = self.redis_conn.register_script(SCORE_SCRIPT)
 
     def _batch_exe(self, last=False):
         if not last:
@@ -87,7 +140,24 @@ class RedisOps(object):
             or self.redis_conn.exists(proxy)
         ):
             return
-        self.rpipe.hmset(
+        self._add_proxy(self.rpipe, proxy)
+        self._batch_exe()
+
+    def set_proxies_pipeline(self, proxies):
+        """Save new proxies with 2 round trips whatever the number of proxies"""
+        proxies = [p for p in proxies if p and is_valid_proxy(proxy=p)]
+        if not proxies:
+            return
+        pipe = self.redis_conn.pipeline(transaction=False)
+        for proxy in proxies:
+            pipe.exists(proxy)
+        for proxy, exists in zip(proxies, pipe.execute()):
+            if not exists:
+                self._add_proxy(pipe, proxy)
+        pipe.execute()
+
+    def _add_proxy(self, pipe, proxy):
+        pipe.hmset(
             proxy,
             {
                 "used_count": 0,
@@ -98,37 +168,41 @@ class RedisOps(object):
                 "score": 0,
             },
         )
-        self._batch_exe()
+        pipe.zadd(SCORE_ZSET, {proxy: 0})
 
     def inc_stat(self, item):
+        now = int(time.time())
         self.rpipe.hincrby(item["proxy"], "used_count")
         self.rpipe.hincrby(item["proxy"], "success_count", item["success"])
         self.rpipe.hincrby(item["proxy"], "total_seconds", item["seconds"])
         self.rpipe.hset(item["proxy"], "last_fail", item["fail"])
         if item["success"] != 0:
-            self.rpipe.hset(item["proxy"], "timestamp", int(time.time()))
+            self.rpipe.hset(item["proxy"], "timestamp", now)
+        self.score_script(
+            keys=[item["proxy"], SCORE_ZSET], args=[now], client=self.rpipe
+        )
         self.rpipe.execute()
 
-    def map_all(self, op, need_op, match="*", **kwargs):
-        # apply operation to each item
+    def rescore_all(self):
+        """Recompute the score of every proxy and rebuild the score zset"""
         total = 0
-        nop = 0
-        ope = getattr(self.rpipe, op)
-        if not ope:
-            logger.warning(f"Invalid operation: {op}")
-            return
-        for pkey in self.redis_conn.scan_iter(match=match):
-            total += 1
-            # if self.redis_conn.hget(pkey, 'fail') == b'badcontent':
-            #     print(pkey)
-            # else:
-            #     continue
-            row = self.redis_conn.hgetall(pkey)
-            if need_op(row):
-                ope(pkey, **kwargs)
-                nop += 1
-        self.rpipe.execute()
-        logger.info(f"{op} operations to {nop} proxies, total {total} scanned")
+        cursor = 0
+        # the whole sweep scores freshness against the same clock
+        now = int(time.time())
+        while True:
+            cursor, pkeys = self.redis_conn.scan(
+                cursor, match="http*://*", count=REDIS_SCAN_COUNT
+            )
+            if pkeys:
+                total += len(pkeys)
+                pipe = self.redis_conn.pipeline(transaction=False)
+                for pkey in pkeys:
+                    self.score_script(keys=[pkey, SCORE_ZSET], args=[now], client=pipe)
+                pipe.execute()
+            if cursor == 0:
+                break
+        self.redis_conn.delete(POOL_SNAPSHOT, POOL_SNAPSHOT_ID)
+        logger.info(f"{total} proxies rescored")
 
 
 ####
@@ -138,13 +212,13 @@ def is_valid_proxy(ip=None, port=None, protocol=None, proxy=None):
             protocol, ip, port = proxy.split(":")
             ip = ip.lstrip("//")
         except ValueError as e:
-            logger.warning(f"{proxy}: {e}")
+            logger.debug("%s: %s", proxy, e)
             return False
     try:
         ipaddress.ip_address(ip)
         port = int(port)
     except ValueError as e:
-        logger.warning(f"{ip}:{port} {e}")
+        logger.debug("%s:%s %s", ip, port, e)
         return False
     return (
         0 <= port
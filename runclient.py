@@ -16,6 +16,9 @@ if __name__ == "__main__":
         "-d", "--delete", help="delete all failed proxies", action="store_true"
     )
     redispar.add_argument("-s", "--stat", help="Stat of redis", action="store_true")
+    redispar.add_argument(
+        "-r", "--rescore", help="rescore all proxies", action="store_true"
+    )
 
     filepar = subparsers.add_parser("file", help="Load or dump proxy file")
     filepar.add_argument(
@@ -45,6 +48,8 @@ if __name__ == "__main__":
             pc.del_all_fails()
         elif args.stat:
             pass
+        elif args.rescore:
+            pc.ro.rescore_all()
     elif args.command == "file":
         pc = ProxyClient()
         if args.load: